@@ -476,10 +476,7 @@ def tokenize_strings(tokenizer, strings, max_length):
     all_token_ids = []
     for string in strings:
         tokens = tokenizer.tokenize(string)
-        token_ids = tokenizer.encode(tokens,
-                                     add_special_tokens=False,
-                                     max_length=max_length,
-                                     pad_to_max_length=False)
+        token_ids = tokenizer.convert_tokens_to_ids(tokens[:max_length])
         all_tokens.append(tokens)
         all_token_ids.append(token_ids)
     return all_tokens, all_token_ids
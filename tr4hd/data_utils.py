@@ -1,4 +1,6 @@
-import glob, os, re, logging, shutil
+import os, re, logging, shutil, functools
+from collections import Counter
+from types import MappingProxyType
 import numpy as np
 import torch
 from torch.utils.data import TensorDataset
@@ -8,6 +10,7 @@ logger = logging.getLogger(__name__)
 PAD_TOKEN=0
 SEGMENT_ID=0
 MASK_PADDING_WITH_ZERO=True
+READ_BUFFER_SIZE=1024*1024
 
 def make_candidate_set(opt, tokenizer, candidate_data):
     """ Make unlabeled dataset for candidates.
@@ -54,15 +57,13 @@ def make_train_set(opt, tokenizer, train_data, max_pos_ratio=0.5, verbose=False)
     for i in range(len(gold_cand_ids)):
         np.random.shuffle(gold_cand_ids[i])
 
-    # Subsample positive examples if necessary
+    # Subsample positive examples if necessary, only visiting the
+    # queries that have too many
     max_pos = int(max_pos_ratio * opt.per_query_nb_examples)
-    nb_pos_discarded = 0
-    for i in range(len(gold_cand_ids)):
-        pos = gold_cand_ids[i]
-        if len(pos) > max_pos:
-            kept = pos[:max_pos]
-            nb_pos_discarded += len(pos) - len(kept)
-            gold_cand_ids[i] = kept
+    nb_pos = np.array([len(pos) for pos in gold_cand_ids], dtype=np.int64)
+    nb_pos_discarded = int(np.maximum(0, nb_pos - max_pos).sum())
+    for i in np.flatnonzero(nb_pos > max_pos).tolist():
+        gold_cand_ids[i] = gold_cand_ids[i][:max_pos]
     if nb_pos_discarded > 0 and verbose:
         msg = "  {} positive hypernyms removed because the query had more than {}".format(nb_pos_discarded, opt.per_query_nb_examples)
         logger.warning(msg)
@@ -70,14 +71,18 @@ def make_train_set(opt, tokenizer, train_data, max_pos_ratio=0.5, verbose=False)
     # Sample negative examples for training
     all_cand_ids = list(range(len(candidates)))
     neg_cand_ids = sample_negative_examples(all_cand_ids, gold_cand_ids, opt.per_query_nb_examples, verbose=verbose)
-    cand_ids = []
-    labels = []
+    # Positives have been subsampled to at most per_query_nb_examples,
+    # so every query has exactly per_query_nb_examples examples
+    cand_ids = np.empty((len(queries), opt.per_query_nb_examples), dtype=np.int64)
+    labels = np.empty((len(queries), opt.per_query_nb_examples), dtype=np.float32)
     for i in range(len(queries)):
-        xy = [(x,1) for x in gold_cand_ids[i]] + [(x,0) for x in neg_cand_ids[i]]
-        np.random.shuffle(xy)
-        x,y = zip(*xy)
-        cand_ids.append(x)
-        labels.append(y)
+        pos = np.asarray(gold_cand_ids[i], dtype=np.int64)
+        neg = np.asarray(neg_cand_ids[i], dtype=np.int64)
+        x = np.concatenate([pos, neg])
+        y = np.concatenate([np.ones(len(pos), dtype=np.float32), np.zeros(len(neg), dtype=np.float32)])
+        perm = np.random.permutation(len(x))
+        cand_ids[i] = x[perm]
+        labels[i] = y[perm]
 
     # Build dataset
     return make_q_and_c_dataset(opt, tokenizer, queries, cand_ids, candidate_labels=labels, verbose=verbose)
@@ -95,54 +100,74 @@ def make_dev_set(opt, tokenizer, dev_data):
     # Load validation data
     queries = dev_data["queries"]
     gold_cand_ids = dev_data["gold_hypernym_candidate_ids"]
+    nb_queries = len(queries)
     nb_candidates = len(dev_data["candidates"])
-    all_cand_ids = list(range(nb_candidates))
-    cand_ids = []
-    labels = []
-    for i in range(len(queries)):
-        y = [0] * nb_candidates
-        for c in gold_cand_ids[i]:
-            y[c] = 1
-        cand_ids.append(all_cand_ids[:])
-        labels.append(y)
+
+    # All queries share the same candidates, so we use a single row
+    # of candidate IDs, expanded (without copying) to all queries
+    all_cand_ids = torch.arange(nb_candidates, dtype=torch.long)
+    cand_ids = all_cand_ids.unsqueeze(0).expand(nb_queries, -1)
+
+    # Set labels of gold hypernyms to 1
+    rows = torch.tensor([i for (i,g_list) in enumerate(gold_cand_ids) for _ in g_list], dtype=torch.long)
+    cols = torch.tensor([g for g_list in gold_cand_ids for g in g_list], dtype=torch.long)
+    labels = torch.zeros((nb_queries, nb_candidates), dtype=torch.float32)
+    labels.index_put_((rows, cols), torch.ones_like(rows, dtype=torch.float32))
 
     # Build dataset
     return make_q_and_c_dataset(opt, tokenizer, queries, cand_ids, candidate_labels=labels, verbose=False)
 
 
-def sample_negative_examples(candidate_ids, pos_candidate_ids, per_query_nb_examples, verbose=False):
+def sample_negative_examples(candidate_ids, pos_candidate_ids, per_query_nb_examples, verbose=False, chunk_size=10000):
     """ Sample negative examples.
 
     Args:
-    - candidate_ids: list of candidate IDs
+    - candidate_ids: list of candidate IDs (non-negative integers)
     - pos_candidate_ids: list of lists of positive candidate IDs (one for each query)
     - per_query_nb_examples: sum of number of positive and negative examples per query. Note: if any queries have more than this number of positive examples, some will be discarded.
+    - chunk_size: number of queries for which we sample at once
+
+    Return list of arrays of negative candidate IDs (one for each query).
     
     """
     if verbose:
         logger.info("  Sampling negative examples with per_query_nb_examples={}".format(per_query_nb_examples))
-    # Sample a bunch of indices at once to save time on generating random candidate indices
-    buffer_size = 1000000
-    sampled_indices = np.random.randint(len(candidate_ids), size=buffer_size)
+    candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+    nb_candidates = len(candidate_ids)
     nb_queries = len(pos_candidate_ids)
-    neg_candidate_ids = []
-    buffer_index = 0
-    for i in range(nb_queries):
-        pos = pos_candidate_ids[i]
-        pos_set = set(pos)
-        nb_neg = max(0, per_query_nb_examples-len(pos))
-        neg = []
-        while len(neg) < nb_neg:
-            sampled_index = sampled_indices[buffer_index]
-            buffer_index += 1 
-            if buffer_index == buffer_size:
-                # Sample more indices
-                sampled_indices = np.random.randint(len(candidate_ids), size=buffer_size)
-                buffer_index = 0
-            if candidate_ids[sampled_index] not in pos_set:
-                neg.append(candidate_ids[sampled_index])
-        neg_candidate_ids.append(neg)
-    return neg_candidate_ids
+
+    # Store the positive examples of all queries in CSR format, and
+    # encode each (query, candidate ID) pair as a single key, so that
+    # we can reject positives for many queries at once
+    nb_pos = np.array([len(pos) for pos in pos_candidate_ids], dtype=np.int64)
+    nb_neg = np.maximum(0, per_query_nb_examples - nb_pos)
+    pos_flat = np.fromiter((c for pos in pos_candidate_ids for c in pos), dtype=np.int64, count=int(nb_pos.sum()))
+    key_base = int(max(candidate_ids.max(initial=0), pos_flat.max(initial=0))) + 1
+    pos_keys = np.repeat(np.arange(nb_queries, dtype=np.int64), nb_pos) * key_base + pos_flat
+    pos_offsets = np.concatenate([[0], np.cumsum(nb_pos)])
+
+    neg = np.empty((nb_queries, per_query_nb_examples), dtype=np.int64)
+    nb_found = np.zeros(nb_queries, dtype=np.int64)
+    for start in range(0, nb_queries, chunk_size):
+        end = min(start+chunk_size, nb_queries)
+        chunk_pos_keys = pos_keys[pos_offsets[start]:pos_offsets[end]]
+        todo = np.arange(start, end)
+        todo = todo[nb_neg[todo] > 0]
+        while len(todo):
+            # Draw a batch of candidates for each query (with a bit of
+            # oversampling to make up for rejected positives), reject
+            # positives, and keep the first valid ones
+            nb_missing = nb_neg[todo] - nb_found[todo]
+            width = int(1.2 * nb_missing.max()) + 1
+            sampled = candidate_ids[np.random.randint(nb_candidates, size=(len(todo), width))]
+            valid = np.isin(todo[:,None] * key_base + sampled, chunk_pos_keys, invert=True)
+            rank = np.cumsum(valid, axis=1)
+            keep = valid & (rank <= nb_missing[:,None])
+            rows, cols = np.nonzero(keep)
+            neg[todo[rows], nb_found[todo[rows]] + rank[rows, cols] - 1] = sampled[rows, cols]
+            nb_found[todo] += keep.sum(axis=1)
+            todo = todo[nb_found[todo] < nb_neg[todo]]
+    return [neg[i,:nb_neg[i]] for i in range(nb_queries)]
 
 
 def load_hypernyms(path):
@@ -150,7 +175,7 @@ def load_hypernyms(path):
     hypernyms.
 
     """
-    with open(path) as f:
+    with open(path, buffering=READ_BUFFER_SIZE, encoding="utf-8") as f:
         hypernyms = []
         for line in f:
             h_list = line.strip().split("\t")
@@ -158,6 +183,22 @@ def load_hypernyms(path):
     return hypernyms
 
 
+@functools.lru_cache(maxsize=8)
+def get_constant_inputs(nb_examples, max_length, value, device):
+    """ Return (cached) tensor of shape (nb_examples, max_length) filled
+    with value. The tensor is shared between calls, so it must not be
+    modified in place.
+
+    """
+    return torch.full((nb_examples, max_length), value, dtype=torch.long, device=device)
+
+
+@functools.lru_cache(maxsize=8)
+def get_positions(max_length, device):
+    """ Return (cached) tensor of shape (1, max_length) containing positions 0 to max_length-1. """
+    return torch.arange(max_length, device=device).unsqueeze(0)
+
+
 def get_missing_inputs(opt, token_ids, nb_tokens, lang_id):
     """ Given a tensor of padded token ids and a tensor indicating the number of actual (non padding tokens) per example, return dict containing additional inputs needed to feed the transformer.
     
@@ -175,48 +216,45 @@ def get_missing_inputs(opt, token_ids, nb_tokens, lang_id):
     
     # Segment IDs
     if opt.encoder_type == 'bert':
-        inputs["token_type_ids"] = torch.tensor([[SEGMENT_ID] * max_length] * nb_examples, dtype=torch.long, requires_grad=False, device=opt.device)
+        inputs["token_type_ids"] = get_constant_inputs(nb_examples, max_length, SEGMENT_ID, opt.device)
     else:
         inputs["token_type_ids"] = None
         
     # Language IDs
     if opt.encoder_type == 'xlm':
-        inputs["langs"] = torch.tensor([[lang_id] * max_length] * nb_examples, dtype=torch.long, requires_grad=False, device=opt.device)
+        inputs["langs"] = get_constant_inputs(nb_examples, max_length, lang_id, opt.device)
     else:
         inputs["langs"] = None
         
     # Attention mask
-    attention_mask = []
-    for i in range(nb_examples):
-        nb_tok = nb_tokens[i]
-        padding_length = opt.max_seq_length - nb_tok
-        mask = [1] * nb_tok + [0 if MASK_PADDING_WITH_ZERO else 1] * padding_length
-        attention_mask.append(mask)
-    inputs["attention_mask"] = torch.tensor(attention_mask, dtype=torch.long, requires_grad=False, device=opt.device)
+    positions = get_positions(opt.max_seq_length, opt.device)
+    attention_mask = positions < nb_tokens.view(-1, 1).to(opt.device)
+    if not MASK_PADDING_WITH_ZERO:
+        attention_mask = torch.ones_like(attention_mask)
+    inputs["attention_mask"] = attention_mask.long()
 
     return inputs
 
 
-def encode_string_inputs(opt, tokenizer, strings, verbose=False):
-    """ Tokenize strings and return 2 tensors: input_ids (padded), nb_tokens (not including padding)
+def encode_string_inputs(opt, tokenizer, strings, verbose=False, chunk_size=5000):
+    """ Tokenize strings and return 2 tensors: input_ids (padded), nb_tokens (not including padding).
+    Tensors are kept on CPU; batches are moved to the device when they are used.
 
     """
-    input_ids = []
-    nb_tokens = []
-    nb_processed = 0
-    for string in strings:
-        tokens = tokenizer.tokenize(string)
-        token_ids = tokenizer.encode(tokens, add_special_tokens=True, max_length=opt.max_seq_length, pad_to_max_length=False)
-        nb_tokens.append([len(token_ids)])
-        # Pad
-        padding_length = opt.max_seq_length - len(token_ids)
-        token_ids += [PAD_TOKEN] * padding_length
-        input_ids.append(token_ids)
-        nb_processed += 1
-        if verbose and nb_processed % 5000 == 0:
-            logger.info("  Nb strings processed: {}".format(nb_processed))
-    input_ids = torch.tensor(input_ids, dtype=torch.long, requires_grad=False, device=opt.device)
-    nb_tokens = torch.tensor(nb_tokens, dtype=torch.long, requires_grad=False, device=opt.device)    
+    input_ids = [torch.empty((0, opt.max_seq_length), dtype=torch.long)]
+    nb_tokens = [torch.empty((0, 1), dtype=torch.long)]
+    for start in range(0, len(strings), chunk_size):
+        # Tokenize, encode and pad a whole chunk of strings at once
+        enc = tokenizer.batch_encode_plus(strings[start:start+chunk_size], add_special_tokens=True, max_length=opt.max_seq_length, pad_to_max_length=True, return_attention_mask=True, return_tensors='pt')
+        mask = enc["attention_mask"]
+        chunk_input_ids = enc["input_ids"]
+        chunk_input_ids[mask == 0] = PAD_TOKEN
+        input_ids.append(chunk_input_ids)
+        nb_tokens.append(mask.sum(dim=1, keepdim=True))
+        if verbose:
+            logger.info("  Nb strings processed: {}".format(start + len(chunk_input_ids)))
+    input_ids = torch.cat(input_ids).long()
+    nb_tokens = torch.cat(nb_tokens).long()
     return input_ids, nb_tokens
 
 
@@ -240,40 +278,44 @@ def make_q_and_c_dataset(opt, tokenizer, queries, candidate_ids, candidate_label
     - opt
     - tokenizer
     - queries: list of query strings
-    - candidate_ids: list of lists containing the IDs of all the candidates to evaluate for a given query
-    - candidate_labels: (optional) list of lists containing the labels of the candidate_ids (0 or 1)
+    - candidate_ids: list of lists (or 2-D tensor) containing the IDs of all the candidates to evaluate for a given query
+    - candidate_labels: (optional) list of lists (or 2-D tensor) containing the labels of the candidate_ids (0 or 1)
 
     """
 
     # Check args
     assert len(queries) == len(candidate_ids)
-    nb_candidates_fd = {}
-    for c in candidate_ids:
-        length = len(c)
-        if length not in nb_candidates_fd:
-            nb_candidates_fd[length] = 0
-        nb_candidates_fd[length] += 1
+    if torch.is_tensor(candidate_ids):
+        nb_candidates_fd = {candidate_ids.size(1): candidate_ids.size(0)}
+    else:
+        nb_candidates_fd = Counter(len(c) for c in candidate_ids)
     if len(nb_candidates_fd) > 1:
         msg = "Nb candidates must be same for all queries. "
         msg += "Found the following numbers: %s" % ", ".join(["{} (count={})".format(k,v) for (k,v) in nb_candidates_fd.items()])
         raise ValueError(msg)
 
+    # Convert to tensors through NumPy, which is much faster than
+    # torch.tensor on nested lists
+    if not torch.is_tensor(candidate_ids):
+        candidate_ids = torch.from_numpy(np.asarray(candidate_ids, dtype=np.int64))
+    if candidate_labels is not None and not torch.is_tensor(candidate_labels):
+        candidate_labels = torch.from_numpy(np.asarray(candidate_labels, dtype=np.float32))
+
     nb_queries = len(queries)
     nb_pos_examples = 0
     nb_neg_examples = 0
-    if candidate_labels:
-        for labels in candidate_labels:
-            for label in labels:
-                if label == 1:
-                    nb_pos_examples += 1
-                elif label == 0:
-                    nb_neg_examples += 1
-                else:
-                    raise ValueError("unrecognized label '{}'".format(label))
+    if candidate_labels is not None:
+        is_pos = candidate_labels == 1
+        is_neg = candidate_labels == 0
+        is_unk = ~(is_pos | is_neg)
+        if is_unk.any():
+            raise ValueError("unrecognized label '{}'".format(candidate_labels[is_unk][0].item()))
+        nb_pos_examples = int(is_pos.sum())
+        nb_neg_examples = candidate_labels.numel() - nb_pos_examples
     if verbose:
         logger.info("***** Making dataset ******")
         logger.info("  Nb queries: {}".format(nb_queries))
-        if candidate_labels:
+        if candidate_labels is not None:
             logger.info("  Nb positive examples: {}".format(nb_pos_examples))
             logger.info("  Nb negative examples: {}".format(nb_neg_examples))
             logger.info("  Max length: {}".format(opt.max_seq_length))
@@ -286,13 +328,27 @@ def make_q_and_c_dataset(opt, tokenizer, queries, candidate_ids, candidate_label
             logger.info("  query: %s" % queries[i])
             logger.info("  query token IDs: {}".format(input_ids[i]))
             logger.info("  nb tokens (without padding): {}".format(nb_tokens[i]))
-            logger.info("  candidate ids: %s" % " ".join([str(x) for x in candidate_ids[i]]))
-            logger.info("  candidate labels: %s" % " ".join([str(x) for x in candidate_labels[i]]))
-    candidate_ids = torch.tensor(candidate_ids, dtype=torch.long, requires_grad=False, device=opt.device)
-    candidate_labels = torch.tensor(candidate_labels, dtype=torch.float32, requires_grad=False, device=opt.device)
+            logger.info("  candidate ids: %s" % " ".join([str(x) for x in candidate_ids[i].tolist()]))
+            logger.info("  candidate labels: %s" % " ".join([str(x) for x in candidate_labels[i].tolist()]))
+    candidate_ids = candidate_ids.long()
+    candidate_labels = candidate_labels.float()
     return TensorDataset(input_ids, nb_tokens, candidate_ids, candidate_labels)
 
 
+@functools.lru_cache(maxsize=4)
+def load_candidates(data_dir):
+    """Load candidates from data_dir. Return tuple of candidates and
+    read-only mapping from candidate to ID. Results are cached, since
+    the candidates are shared by all set types.
+
+    """
+    path_candidates = os.path.join(data_dir, "candidates.txt")
+    with open(path_candidates, buffering=READ_BUFFER_SIZE, encoding="utf-8") as f:
+        candidates = tuple(line.strip() for line in f)
+    candidate2id = MappingProxyType({x:i for (i,x) in enumerate(candidates)})
+    return candidates, candidate2id
+
+
 def load_hd_data(opt, set_type):
     """Load data from file. 
     Dataset can be a training, dev or test set for hypernym discovery,
@@ -304,23 +360,17 @@ def load_hd_data(opt, set_type):
         raise ValueError("unrecognized set_type '{}'".format(set_type))
 
     # Load candidates, which we need regardless of the set type
-    path_candidates = os.path.join(opt.data_dir, "candidates.txt")
-    candidates = []
-    with open(path_candidates) as f:
-        for line in f:
-            candidates.append(line.strip())
+    candidates, candidate2id = load_candidates(opt.data_dir)
     data = {}
-    data["candidates"] = candidates
-    data["candidate2id"] = {x:i for (i,x) in enumerate(candidates)}
+    data["candidates"] = list(candidates)
+    data["candidate2id"] = candidate2id
     if set_type == "candidates":
         return data
 
     # Load queries
     path_queries = os.path.join(opt.data_dir, "{}.queries.txt".format(set_type))
-    queries = []
-    with open(path_queries) as f:
-        for line in f:
-            queries.append(line.strip())
+    with open(path_queries, buffering=READ_BUFFER_SIZE, encoding="utf-8") as f:
+        queries = [line.strip() for line in f]
     data["queries"] = queries
 
     # Load gold_hypernym_candidate_ids (list of lists, one per
@@ -328,19 +378,26 @@ def load_hd_data(opt, set_type):
     path_gold_hypernyms = os.path.join(opt.data_dir, '{}.gold.tsv'.format(set_type))            
     if (set_type in ["train", "dev"]) or (set_type=='test' and os.path.exists(path_gold_hypernyms)):
         gold_hypernyms = load_hypernyms(path_gold_hypernyms)
+        get_candidate_id = data["candidate2id"].get
         gold_hypernym_candidate_ids = []
         for g_list in gold_hypernyms:
             g_id_list = []
             for g in g_list:
-                if g in data["candidate2id"]:
-                    g_id_list.append(data["candidate2id"][g])
-                else:
+                g_id = get_candidate_id(g)
+                if g_id is None:
                     raise KeyError("Gold hypernym '{}' not in candidate2id".format(g))
+                g_id_list.append(g_id)
             gold_hypernym_candidate_ids.append(g_id_list)
         data["gold_hypernym_candidate_ids"] = gold_hypernym_candidate_ids        
     return data
 
             
+@functools.lru_cache(maxsize=8)
+def get_checkpoint_regex(checkpoint_prefix):
+    """ Return compiled regex matching checkpoint names and capturing the step number. """
+    return re.compile('{}-([0-9]+)'.format(re.escape(checkpoint_prefix)))
+
+
 def rotate_checkpoints(save_total_limit, output_dir, checkpoint_prefix, use_mtime=False, verbose=False):
     if not save_total_limit:
         return
@@ -348,18 +405,20 @@ def rotate_checkpoints(save_total_limit, output_dir, checkpoint_prefix, use_mtim
         return
 
     # Check if we should delete older checkpoint(s)
-    glob_checkpoints = glob.glob(os.path.join(output_dir, '{}-*'.format(checkpoint_prefix)))
-    if len(glob_checkpoints) <= save_total_limit:
+    with os.scandir(output_dir) as entries:
+        checkpoints = [entry for entry in entries if entry.name.startswith('{}-'.format(checkpoint_prefix))]
+    if len(checkpoints) <= save_total_limit:
         return
 
+    checkpoint_regex = get_checkpoint_regex(checkpoint_prefix)
     ordering_and_checkpoint_path = []
-    for path in glob_checkpoints:
+    for entry in checkpoints:
         if use_mtime:
-            ordering_and_checkpoint_path.append((os.path.getmtime(path), path))
+            ordering_and_checkpoint_path.append((entry.stat().st_mtime, entry.path))
         else:
-            regex_match = re.match('.*{}-([0-9]+)'.format(checkpoint_prefix), path)
-            if regex_match and regex_match.groups():
-                ordering_and_checkpoint_path.append((int(regex_match.groups()[0]), path))
+            regex_match = checkpoint_regex.match(entry.name)
+            if regex_match:
+                ordering_and_checkpoint_path.append((int(regex_match.group(1)), entry.path))
 
     checkpoints_sorted = sorted(ordering_and_checkpoint_path)
     checkpoints_sorted = [checkpoint[1] for checkpoint in checkpoints_sorted]
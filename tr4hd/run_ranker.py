@@ -9,7 +9,7 @@ import os, argparse, logging, json, random
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 try:
     from torch.utils.tensorboard import SummaryWriter
@@ -52,9 +52,7 @@ def encode_batch(opt, model, tokenizer, batch, grad=False, these_are_candidates=
 
     """
 
-    batch = tuple(t.to(opt.device) for t in batch)
-    input_ids = batch[0]
-    nb_tokens = batch[1]
+    input_ids, nb_tokens = (t.to(opt.device, non_blocking=True) for t in batch[:2])
     inputs = {'input_ids':input_ids}
     inputs.update(get_missing_inputs(opt, input_ids, nb_tokens, tokenizer.lang2id[opt.lang]))
     if grad:
@@ -75,7 +73,7 @@ def encode_all_inputs(opt, model, tokenizer, inputs, grad=False, these_are_candi
 
     """
     sampler = SequentialSampler(inputs)
-    dataloader = DataLoader(inputs, sampler=sampler, batch_size=batch_size)
+    dataloader = DataLoader(inputs, sampler=sampler, batch_size=batch_size, pin_memory=opt.device.type == 'cuda')
     all_encs = []
     for batch in tqdm(dataloader, desc="Encoding {}".format("candidates" if these_are_candidates else "queries"), leave=False):
         encs = encode_batch(opt, model, tokenizer, batch, grad=grad, these_are_candidates=these_are_candidates)
@@ -108,7 +106,7 @@ def get_model_predictions(opt, model, tokenizer, query_inputs, cand_inputs):
 
     # Make loader for candidates
     sampler = SequentialSampler(cand_inputs) 
-    dataloader = DataLoader(cand_inputs, sampler=sampler, batch_size=opt.eval_batch_size)
+    dataloader = DataLoader(cand_inputs, sampler=sampler, batch_size=opt.eval_batch_size, pin_memory=opt.device.type == 'cuda')
     
     y_probs = [list() for _ in range(len(query_encs))]
     model.eval()
@@ -204,8 +202,10 @@ def evaluate(opt, model, tokenizer, eval_data, cand_inputs):
     nb_queries = len(eval_data)
     nb_candidates = len(cand_inputs)
 
-    # Get model predictions
-    y_probs = get_model_predictions(opt, model, tokenizer, eval_data, cand_inputs)
+    # Get model predictions (only the query inputs are needed, not
+    # the candidate IDs and labels)
+    query_inputs = TensorDataset(*eval_data.tensors[:2])
+    y_probs = get_model_predictions(opt, model, tokenizer, query_inputs, cand_inputs)
     logger.debug("  Range(y_probs): {:.3f}-{:.3f}".format(np.min(y_probs), np.max(y_probs)))
     
     # Get labels
@@ -277,7 +277,7 @@ def train(opt, model, tokenizer):
     # Make training set
     train_set = make_train_set(opt, tokenizer, train_data, max_pos_ratio=opt.max_pos_ratio, verbose=True)
     train_sampler = RandomSampler(train_set) if opt.local_rank == -1 else DistributedSampler(train_set)
-    train_dataloader = DataLoader(train_set, sampler=train_sampler, batch_size=opt.train_batch_size)
+    train_dataloader = DataLoader(train_set, sampler=train_sampler, batch_size=opt.train_batch_size, pin_memory=opt.device.type == 'cuda')
 
     # Set number of epochs and steps 
     if opt.max_steps > 0:
@@ -334,7 +334,7 @@ def train(opt, model, tokenizer):
         if cand_ix == 0 and global_step > 0:
             train_set = make_train_set(opt, tokenizer, train_data, max_pos_ratio=opt.max_pos_ratio, verbose=False)
             train_sampler = RandomSampler(train_set) if opt.local_rank == -1 else DistributedSampler(train_set)
-            train_dataloader = DataLoader(train_set, sampler=train_sampler, batch_size=opt.train_batch_size)
+            train_dataloader = DataLoader(train_set, sampler=train_sampler, batch_size=opt.train_batch_size, pin_memory=opt.device.type == 'cuda')
         epoch_iterator = tqdm(train_dataloader, desc="Step (batch)", leave=False, disable=opt.local_rank not in [-1, 0])
         for step, batch in enumerate(epoch_iterator):
             # Unpack batch
@@ -359,7 +359,7 @@ def train(opt, model, tokenizer):
             scores = model({'query_encs': query_encs}, {'cand_encs':cand_encs})
 
             # Compute loss
-            labels_sub = labels[:,cand_ix]
+            labels_sub = labels[:,cand_ix].to(opt.device, non_blocking=True)
             loss = compute_loss(scores, labels_sub, reduction='mean')
             if opt.n_gpu > 1:
                 loss = loss.mean() # mean() to average on multi-gpu parallel training